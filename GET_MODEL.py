@@ -1,33 +1,405 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import argparse
+import hashlib
+import json
 import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
 
 # --- Step 1: Log in to Hugging Face Hub ---
 # Make sure you have run 'huggingface-cli login' in your terminal
 # and entered your access token.
+# This is only needed when downloading from the Hub, not from a mirror.
 
 # --- Step 2: Define Model and Save Directory ---
 model_id = "google/gemma-3-270m-it"
 save_directory = "./gemma-3-270m-it-local"
 
-# Create the directory if it doesn't exist
-os.makedirs(save_directory, exist_ok=True)
+# Name of the checksum manifest written next to the model files.
+# A directory (or HTTP server) holding the files plus this manifest can be used as a mirror.
+MANIFEST_NAME = "manifest.json"
+CHUNK_SIZE = 1024 * 1024
+
+# When converting, the original files are downloaded here (inside the output directory), so a
+# re-run can tell they are complete and only the converted weights end up in the model directory.
+ORIGINALS_DIRECTORY = ".original"
+
+# Shard size used when converting with --dtype alone. A shard is built in memory before it is
+# written, so this bounds the peak RAM of a conversion.
+DEFAULT_SHARD_SIZE = 2 * 1024 ** 3
+
+
+def list_hub_files(model_id, revision):
+    """Lists the files of a Hub repository with their size and checksum."""
+    from huggingface_hub import HfApi, get_token, hf_hub_url
+
+    token = get_token()
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    info = HfApi().model_info(model_id, revision=revision, files_metadata=True, token=token)
+
+    files = []
+    for sibling in info.siblings:
+        entry = {
+            "name": sibling.rfilename,
+            "size": sibling.size,
+            "url": hf_hub_url(model_id, sibling.rfilename, revision=revision),
+            "headers": headers,
+        }
+        # Large files are stored in LFS with a sha256, small ones only have their git blob id
+        if sibling.lfs is not None:
+            entry["sha256"] = sibling.lfs.sha256
+        else:
+            entry["git_sha1"] = sibling.blob_id
+        files.append(entry)
+    return files
+
+
+def resolve_target_path(target_directory, name):
+    """
+    Joins a file name from a file listing or manifest to the directory it belongs in.
+    Raises ValueError for names that are absolute or lead outside the directory (e.g. '../x').
+    """
+    root = os.path.abspath(target_directory)
+    path = os.path.normpath(os.path.join(root, name))
+    if os.path.isabs(name) or os.path.commonpath([root, path]) != root or path == root:
+        raise ValueError(f"Invalid file name '{name}', it points outside '{target_directory}'.")
+    return path
+
+
+def list_mirror_files(mirror):
+    """Lists the files of a mirror (a local directory or an HTTP base URL) from its manifest."""
+    if mirror.startswith(("http://", "https://")):
+        base_url = mirror.rstrip("/")
+        response = requests.get(f"{base_url}/{MANIFEST_NAME}", timeout=30)
+        response.raise_for_status()
+        manifest = response.json()
+        for entry in manifest["files"]:
+            resolve_target_path(mirror, entry["name"])
+        return [dict(entry, url=f"{base_url}/{entry['name']}", headers={}) for entry in manifest["files"]]
+
+    manifest_path = os.path.join(mirror, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        raise FileNotFoundError(f"No '{MANIFEST_NAME}' found in mirror directory '{mirror}'.")
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    return [dict(entry, path=resolve_target_path(mirror, entry["name"])) for entry in manifest["files"]]
+
+
+def new_hasher(entry):
+    if "sha256" in entry:
+        return hashlib.sha256()
+    if "git_sha1" in entry and entry.get("size") is not None:
+        # Git hashes blobs as sha1("blob <size>\0" + content)
+        hasher = hashlib.sha1()
+        hasher.update(f"blob {entry['size']}\0".encode())
+        return hasher
+    return None
+
+
+def expected_digest(entry):
+    return entry["sha256"] if "sha256" in entry else entry["git_sha1"]
+
+
+def hash_file(path, hasher):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def is_up_to_date(path, entry):
+    """Checks whether a previously downloaded file is complete and matches its checksum."""
+    if not os.path.isfile(path):
+        return False
+    if entry.get("size") is not None and os.path.getsize(path) != entry["size"]:
+        return False
+    hasher = new_hasher(entry)
+    return hasher is None or hash_file(path, hasher) == expected_digest(entry)
+
+
+def open_source(entry, offset):
+    """
+    Returns (chunks, resumed) for a file starting at `offset`.
+    `resumed` is False if the source could not honour the offset and sends the file from the start.
+    """
+    if "path" in entry:
+        def read_local():
+            with open(entry["path"], "rb") as f:
+                f.seek(offset)
+                yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+        return read_local(), True
+
+    headers = dict(entry.get("headers", {}))
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    response = requests.get(entry["url"], headers=headers, stream=True, timeout=60)
+    if response.status_code == 416:
+        # The partial file is already complete
+        response.close()
+        return iter(()), True
+    response.raise_for_status()
+    return response.iter_content(chunk_size=CHUNK_SIZE), response.status_code == 206
+
+
+def fetch_file(entry, target_directory):
+    """
+    Downloads one file to disk, resuming from a previous '.part' file if there is one,
+    and verifies its checksum before moving it into place.
+    """
+    target_path = resolve_target_path(target_directory, entry["name"])
+    if is_up_to_date(target_path, entry):
+        return entry["name"], "already present"
+
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    part_path = target_path + ".part"
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if entry.get("size") is not None and offset > entry["size"]:
+        offset = 0
+
+    chunks, resumed = open_source(entry, offset)
+    if not resumed:
+        offset = 0
+
+    # Hash the bytes already on disk so the checksum covers the whole file
+    hasher = new_hasher(entry)
+    if hasher is not None and offset:
+        with open(part_path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                hasher.update(chunk)
+
+    with open(part_path, "ab" if offset else "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+
+    if hasher is not None and hasher.hexdigest() != expected_digest(entry):
+        os.remove(part_path)
+        raise ValueError(f"Checksum mismatch for '{entry['name']}', the partial download was removed.")
+
+    os.replace(part_path, target_path)
+    return entry["name"], "resumed" if offset else "downloaded"
+
+
+def download_files(files, target_directory, workers):
+    """Downloads all files in parallel. Files that fail are reported and can be resumed by re-running."""
+    failures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_file, entry, target_directory): entry for entry in files}
+        for future in as_completed(futures):
+            name = futures[future]["name"]
+            try:
+                _, outcome = future.result()
+                print(f"  {name}: {outcome}")
+            except Exception as e:
+                print(f"  {name}: failed ({e})")
+                failures.append(name)
+    return failures
+
+
+def parse_size(text):
+    """Parses sizes such as '500MB' or '2GB' into bytes. Used as an argparse type."""
+    units = {"KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+    normalized = text.strip().upper()
+    try:
+        for unit, factor in units.items():
+            if normalized.endswith(unit):
+                size = int(float(normalized[:-len(unit)]) * factor)
+                break
+        else:
+            size = int(normalized)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size '{text}', use bytes or a KB/MB/GB suffix (e.g. 500MB)")
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"invalid size '{text}', it must be positive")
+    return size
+
+
+def positive_int(text):
+    """Parses a whole number greater than zero. Used as an argparse type."""
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number '{text}', use a whole number (e.g. 4)")
+    if value <= 0:
+        raise argparse.ArgumentTypeError(f"invalid number '{text}', it must be positive")
+    return value
+
+
+def is_weight_file(name):
+    return name.endswith(".safetensors") or name == "model.safetensors.index.json"
+
+
+def remove_stale_weights(directory, keep):
+    """Removes weight files (e.g. shards from an earlier conversion) that are not in `keep`."""
+    for name in os.listdir(directory):
+        if is_weight_file(name) and name not in keep:
+            os.remove(os.path.join(directory, name))
+
+
+def convert_safetensors(source_directory, directory, shard_size, dtype):
+    """
+    Re-shards the safetensors weights in `source_directory` into `directory` and optionally casts
+    floating point tensors to `dtype`. The other files are copied over unchanged.
+    Tensors are streamed one at a time, so at most one shard (of `shard_size`
+    bytes, plus one tensor) is held in memory.
+    """
+    import torch
+    from safetensors import safe_open
+    from safetensors.torch import save_file
+
+    source_files = sorted(name for name in os.listdir(source_directory) if name.endswith(".safetensors"))
+    if not source_files:
+        print("No safetensors files to convert.")
+        return
+
+    for root, _, names in os.walk(source_directory):
+        for name in names:
+            relative_name = os.path.relpath(os.path.join(root, name), source_directory)
+            if is_weight_file(relative_name) or name.endswith(".part"):
+                continue
+            os.makedirs(os.path.dirname(os.path.join(directory, relative_name)), exist_ok=True)
+            shutil.copy2(os.path.join(root, name), os.path.join(directory, relative_name))
+
+    torch_dtype = getattr(torch, dtype) if dtype else None
+    staging_directory = os.path.join(directory, ".converting")
+    shutil.rmtree(staging_directory, ignore_errors=True)
+    os.makedirs(staging_directory)
+
+    shard_names = []
+    weight_map = {}
+    total_size = 0
+    shard, shard_bytes = {}, 0
+
+    def flush_shard():
+        nonlocal shard, shard_bytes
+        if shard:
+            shard_name = f"shard-{len(shard_names):05d}.safetensors"
+            save_file(shard, os.path.join(staging_directory, shard_name), metadata={"format": "pt"})
+            shard_names.append(shard_name)
+            shard, shard_bytes = {}, 0
+
+    for source_file in source_files:
+        with safe_open(os.path.join(source_directory, source_file), framework="pt") as f:
+            for key in f.keys():
+                tensor = f.get_tensor(key)
+                if torch_dtype is not None and tensor.is_floating_point():
+                    tensor = tensor.to(torch_dtype)
+                tensor_bytes = tensor.numel() * tensor.element_size()
+                if shard and shard_bytes + tensor_bytes > shard_size:
+                    flush_shard()
+                shard[key] = tensor.contiguous()
+                shard_bytes += tensor_bytes
+                total_size += tensor_bytes
+                weight_map[key] = len(shard_names)
+    flush_shard()
+
+    # Replace the old weights with the new shards, using the usual Hugging Face naming
+    if len(shard_names) == 1:
+        final_names = ["model.safetensors"]
+    else:
+        final_names = [f"model-{i + 1:05d}-of-{len(shard_names):05d}.safetensors" for i in range(len(shard_names))]
+    keep = final_names + (["model.safetensors.index.json"] if len(final_names) > 1 else [])
+    remove_stale_weights(directory, keep)
+    for shard_name, final_name in zip(shard_names, final_names):
+        os.replace(os.path.join(staging_directory, shard_name), os.path.join(directory, final_name))
+    os.rmdir(staging_directory)
+
+    if len(final_names) > 1:
+        index = {
+            "metadata": {"total_size": total_size},
+            "weight_map": {key: final_names[i] for key, i in weight_map.items()},
+        }
+        with open(os.path.join(directory, "model.safetensors.index.json"), "w") as f:
+            json.dump(index, f, indent=2)
+
+    if dtype:
+        config_path = os.path.join(directory, "config.json")
+        if os.path.isfile(config_path):
+            with open(config_path) as f:
+                config = json.load(f)
+            config["torch_dtype"] = dtype
+            with open(config_path, "w") as f:
+                json.dump(config, f, indent=2)
+
+    print(f"Converted weights into {len(final_names)} shard(s) ({total_size / 1024 ** 2:.1f} MB).")
+
+
+def write_manifest(directory):
+    """Writes the checksum manifest so this directory can serve as a mirror for other hosts."""
+    files = []
+    for root, dirs, names in os.walk(directory):
+        # Skip the originals kept for conversion and conversion leftovers
+        dirs[:] = [name for name in dirs if not name.startswith(".")]
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            relative_name = os.path.relpath(path, directory).replace(os.sep, "/")
+            if relative_name == MANIFEST_NAME or relative_name.endswith(".part"):
+                continue
+            files.append({
+                "name": relative_name,
+                "size": os.path.getsize(path),
+                "sha256": hash_file(path, hashlib.sha256()),
+            })
+    with open(os.path.join(directory, MANIFEST_NAME), "w") as f:
+        json.dump({"files": files}, f, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Download (and optionally convert) a model for the local server.")
+    parser.add_argument("--model-id", default=model_id, help="Hugging Face repository to download.")
+    parser.add_argument("--revision", default="main", help="Branch, tag or commit to download from the Hub.")
+    parser.add_argument("--output", default=save_directory, help="Directory to save the model files to.")
+    parser.add_argument("--mirror", help="Local directory or HTTP URL with the model files and a manifest.json, used instead of the Hub.")
+    parser.add_argument("--workers", type=positive_int, default=4, help="Number of files downloaded in parallel.")
+    parser.add_argument("--shard-size", type=parse_size, help="Re-shard the weights into files of at most this size (e.g. 500MB). Defaults to 2GB when only --dtype is given.")
+    parser.add_argument("--dtype", choices=["float16", "bfloat16", "float32"], help="Cast the floating point weights to this type.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    # Create the directory if it doesn't exist
+    os.makedirs(args.output, exist_ok=True)
+
+    try:
+        # --- Step 3: List the Files to Fetch ---
+        if args.mirror:
+            print(f"Reading file list from mirror '{args.mirror}'...")
+            files = list_mirror_files(args.mirror)
+        else:
+            print(f"Reading file list for '{args.model_id}' from the Hugging Face Hub...")
+            files = list_hub_files(args.model_id, args.revision)
+
+        # --- Step 4: Download the Files Straight to Disk ---
+        # Files to be converted are kept apart, so re-runs find them complete instead of re-downloading
+        convert = bool(args.shard_size or args.dtype)
+        download_directory = os.path.join(args.output, ORIGINALS_DIRECTORY) if convert else args.output
+        print(f"Downloading {len(files)} files with {args.workers} workers...")
+        failures = download_files(files, download_directory, args.workers)
+        if failures:
+            print(f"\n❌ {len(failures)} file(s) failed: {', '.join(failures)}")
+            print("Run the script again to resume the interrupted downloads.")
+            sys.exit(1)
 
-try:
-    # --- Step 3: Download and Save Tokenizer ---
-    print(f"Downloading tokenizer for '{model_id}'...")
-    tokenizer = AutoTokenizer.from_pretrained(model_id)
-    tokenizer.save_pretrained(save_directory)
-    print(f"Tokenizer saved successfully to '{save_directory}'")
+        # --- Step 5: Optionally Convert the Weights ---
+        if convert:
+            print("Converting weights...")
+            shard_size = args.shard_size or DEFAULT_SHARD_SIZE
+            convert_safetensors(download_directory, args.output, shard_size, args.dtype)
+        else:
+            # Drop shards left behind by an earlier conversion
+            remove_stale_weights(args.output, {entry["name"] for entry in files})
 
-    # --- Step 4: Download and Save Model ---
-    print(f"Downloading model '{model_id}'... This may take a while.")
-    model = AutoModelForCausalLM.from_pretrained(model_id)
-    model.save_pretrained(save_directory)
-    print(f"Model saved successfully to '{save_directory}'")
+        write_manifest(args.output)
 
-    print("\n✅ Download and save complete.")
-    print(f"You can now find the model files in the '{save_directory}' directory.")
+        print("\n✅ Download and save complete.")
+        print(f"You can now find the model files in the '{args.output}' directory.")
 
-except Exception as e:
-    print(f"\n❌ An error occurred: {e}")
-    print("Please ensure you have accepted the model's terms on the Hugging Face website and are logged in via 'huggingface-cli login'.")
\ No newline at end of file
+    except Exception as e:
+        print(f"\n❌ An error occurred: {e}")
+        print("Please ensure you have accepted the model's terms on the Hugging Face website and are logged in via 'huggingface-cli login'.")
+        sys.exit(1)
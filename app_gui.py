@@ -1,5 +1,5 @@
 import tkinter as tk
-from tkinter import ttk, scrolledtext
+from tkinter import ttk, scrolledtext, filedialog
 import multiprocessing
 import time
 import os
@@ -9,6 +9,15 @@ import torch
 import threading
 import signal
 import sys
+import uuid
+import tempfile
+import hashlib
+import json
+import math
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from transformers.generation.streamers import BaseStreamer
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
 
 # --- Part 1: Flask Web Server ---
 # This code will be run in a separate process.
@@ -17,6 +26,714 @@ import sys
 current_generation_thread = None
 stop_generation_flag = threading.Event()
 
+# Global variables for the server lifecycle (draining and hot reload)
+draining_flag = threading.Event()
+active_requests = 0
+active_requests_lock = threading.Lock()
+model_reload_lock = threading.Lock()
+
+# How long the GUI waits for in-flight generations to finish before terminating the server
+DRAIN_TIMEOUT_SECONDS = 60
+
+# The server listens on all interfaces, but /drain and /reload-model only accept requests from this machine
+LOOPBACK_ADDRESSES = ("127.0.0.1", "::1", "::ffff:127.0.0.1")
+
+# Global variables for profiling (per-request traces and the /debug/profile endpoint)
+stored_traces = OrderedDict()
+stored_traces_lock = threading.Lock()
+profile_lock = threading.Lock()
+# The torch profiler only records ops of the thread that started it and only one can run per
+# process, so /debug/profile?mode=torch opens a window that generating threads take turns profiling in
+torch_profile_window = threading.Event()
+torch_profiler_lock = threading.Lock()
+torch_profile_started = threading.Event()
+torch_profile_events = []
+
+MAX_STORED_TRACES = 50
+MAX_PROFILE_SECONDS = 60
+PROFILE_SAMPLE_INTERVAL = 0.01
+
+# Model registry configuration, read from a models.json next to this script. Without one,
+# the server hosts only the model downloaded by GET_MODEL.py.
+MODEL_REGISTRY_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models.json")
+DEFAULT_MODELS = {"gemma-3-270m-it": "./gemma-3-270m-it-local"}
+DEFAULT_DEVICE = "cpu"  # Change to "cuda" if you have a compatible GPU
+DEFAULT_MEMORY_BUDGET_MB = 4096
+
+# Files that define a tokenizer, including its chat template; checkpoints with identical files share one tokenizer instance
+TOKENIZER_FILES = ("tokenizer.json", "tokenizer.model", "tokenizer_config.json", "special_tokens_map.json", "added_tokens.json",
+                   "chat_template.jinja", "chat_template.json")
+WEIGHT_FILE_EXTENSIONS = (".safetensors", ".bin")
+
+
+def tokenizer_fingerprint(model_path):
+    """Hashes the tokenizer files of a model directory."""
+    hasher = hashlib.sha256()
+    for name in TOKENIZER_FILES:
+        path = os.path.join(model_path, name)
+        if os.path.isfile(path):
+            hasher.update(name.encode())
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def estimate_model_bytes(model_path):
+    """Estimates the memory a model will take from the size of its weight files."""
+    return sum(
+        os.path.getsize(os.path.join(model_path, name))
+        for name in os.listdir(model_path)
+        if name.endswith(WEIGHT_FILE_EXTENSIONS)
+    )
+
+
+def load_model(model_path, device, tokenizer=None):
+    """
+    Loads a tokenizer and model from a local directory and warms the model up,
+    so the first real request does not pay the one-off initialisation cost.
+    An already loaded tokenizer can be passed in to share it between checkpoints.
+    """
+    # Check if the path exists to give a better error message
+    if not os.path.isdir(model_path):
+        raise FileNotFoundError(f"The model directory was not found at '{model_path}'. Please ensure it's in the same folder as the script.")
+
+    if tokenizer is None:
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path)
+    model.to(device)
+    model.eval()
+
+    warmup_inputs = tokenizer("Hello", return_tensors="pt").to(device)
+    with torch.no_grad():
+        model.generate(**warmup_inputs, max_new_tokens=1)
+    return tokenizer, model
+
+
+class ModelRegistry:
+    """
+    Serves several models behind one server. Models are loaded on first use, and the
+    most recently used ones stay resident within a memory budget (LRU eviction).
+
+    Requests hold a model through acquire()/release(). A model in use is never evicted,
+    and a hot reload only replaces the entry that new requests will get. A replaced entry
+    still counts towards the memory budget until its last request releases it.
+    """
+
+    def __init__(self, models, default_model, device, memory_budget_bytes):
+        self.paths = dict(models)
+        self.default_model = default_model
+        self.device = device
+        self.memory_budget_bytes = memory_budget_bytes
+        self.resident = OrderedDict()  # name -> entry, least recently used first
+        self.replaced = []  # entries swapped out by a reload but still in use
+        self.tokenizers = {}  # tokenizer fingerprint -> shared tokenizer
+        self.load_locks = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config_path):
+        """
+        Builds the registry from a JSON config file, falling back to the defaults if it is missing.
+        Relative model paths in the file are relative to the file's directory.
+        Raises ValueError if the file is not valid.
+        """
+        config = {}
+        models = DEFAULT_MODELS
+        if os.path.isfile(config_path):
+            with open(config_path) as f:
+                try:
+                    config = json.load(f)
+                except ValueError as e:
+                    raise ValueError(f"'{config_path}' is not valid JSON: {e}")
+            if not isinstance(config, dict):
+                raise ValueError(f"'{config_path}' must contain a JSON object.")
+            if "models" in config:
+                models = config["models"]
+                if not isinstance(models, dict) or not models:
+                    raise ValueError(f"'models' in '{config_path}' must map at least one model name to its directory.")
+                if not all(isinstance(path, str) for path in models.values()):
+                    raise ValueError(f"Every model in '{config_path}' must map to a directory path.")
+                config_directory = os.path.dirname(os.path.abspath(config_path))
+                models = {name: os.path.normpath(os.path.join(config_directory, path)) for name, path in models.items()}
+
+        default_model = config.get("default", next(iter(models)))
+        if default_model not in models:
+            raise ValueError(f"The default model '{default_model}' in '{config_path}' is not one of its models.")
+        device = config.get("device", DEFAULT_DEVICE)
+        memory_budget_mb = config.get("memory_budget_mb", DEFAULT_MEMORY_BUDGET_MB)
+        if isinstance(memory_budget_mb, bool) or not isinstance(memory_budget_mb, (int, float)) or memory_budget_mb <= 0:
+            raise ValueError(f"'memory_budget_mb' in '{config_path}' must be a positive number.")
+        return cls(models, default_model, device, int(memory_budget_mb * 1024 * 1024))
+
+    def acquire(self, name=None):
+        """
+        Returns the entry for a model, loading it if needed, and marks it in use.
+        Raises KeyError for unknown model names.
+        """
+        name = name or self.default_model
+        with self.lock:
+            if name not in self.paths:
+                raise KeyError(name)
+            entry = self.resident.get(name)
+            if entry is not None:
+                self.resident.move_to_end(name)
+                entry["users"] += 1
+                return entry
+            load_lock = self.load_locks.setdefault(name, threading.Lock())
+
+        # Only one thread loads a given model; the others wait for it and reuse the result
+        with load_lock:
+            with self.lock:
+                entry = self.resident.get(name)
+                if entry is not None:
+                    self.resident.move_to_end(name)
+                    entry["users"] += 1
+                    return entry
+                model_path = self.paths[name]
+                # Make room before loading, so the old and new models are not resident at the same time
+                self._evict(estimate_model_bytes(model_path) if os.path.isdir(model_path) else 0)
+
+            entry = self._load(name, model_path)
+            with self.lock:
+                entry["users"] += 1
+                self.resident[name] = entry
+                self._evict(0)
+            return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry["users"] -= 1
+            if entry["users"] == 0 and entry in self.replaced:
+                self.replaced.remove(entry)
+            # Models that could not be evicted while in use may be evictable now
+            self._evict(0)
+
+    def reload(self, name, model_path):
+        """
+        Points `name` at `model_path`. If the model is resident, the new version is loaded
+        next to the old one and swapped in once ready; otherwise it is loaded on next use.
+        """
+        with self.lock:
+            load_lock = self.load_locks.setdefault(name, threading.Lock())
+
+        # Holding the load lock keeps acquire() from loading the old path while the new one loads
+        with load_lock:
+            with self.lock:
+                if name not in self.resident:
+                    self.paths[name] = model_path
+                    return
+
+            # If loading fails, the registry keeps serving the current version unchanged
+            entry = self._load(name, model_path)
+            with self.lock:
+                self.paths[name] = model_path
+                old_entry = self.resident.get(name)
+                if old_entry is not None and old_entry["users"] > 0:
+                    self.replaced.append(old_entry)
+                self.resident[name] = entry
+                self.resident.move_to_end(name)
+                self._evict(0)
+
+    def resident_models(self):
+        with self.lock:
+            return list(self.resident)
+
+    def status(self):
+        with self.lock:
+            return {
+                "default_model": self.default_model,
+                "memory_budget_mb": self.memory_budget_bytes // (1024 * 1024),
+                "replaced_in_use_mb": round(sum(entry["size"] for entry in self.replaced) / (1024 * 1024), 1),
+                "models": [
+                    {
+                        "name": name,
+                        "path": path,
+                        "resident": name in self.resident,
+                        "size_mb": round(self.resident[name]["size"] / (1024 * 1024), 1) if name in self.resident else None,
+                        "active_requests": self.resident[name]["users"] if name in self.resident else 0,
+                    }
+                    for name, path in self.paths.items()
+                ],
+            }
+
+    def _load(self, name, model_path):
+        fingerprint = tokenizer_fingerprint(model_path) if os.path.isdir(model_path) else None
+        with self.lock:
+            shared_tokenizer = self.tokenizers.get(fingerprint)
+
+        print(f"Server Process: Loading model '{name}' from '{model_path}'...")
+        tokenizer, model = load_model(model_path, self.device, tokenizer=shared_tokenizer)
+        size = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+        print(f"Server Process: Model '{name}' loaded ({size / (1024 * 1024):.1f} MB).")
+
+        with self.lock:
+            self.tokenizers.setdefault(fingerprint, tokenizer)
+        return {"name": name, "path": model_path, "tokenizer": tokenizer, "model": model,
+                "size": size, "fingerprint": fingerprint, "users": 0}
+
+    def _evict(self, incoming_bytes):
+        """Evicts idle models, least recently used first, until `incoming_bytes` more fit in the budget. Caller holds self.lock."""
+        resident_bytes = sum(entry["size"] for entry in list(self.resident.values()) + self.replaced)
+        for name in list(self.resident):
+            if resident_bytes + incoming_bytes <= self.memory_budget_bytes:
+                break
+            entry = self.resident[name]
+            if entry["users"] > 0:
+                continue
+            del self.resident[name]
+            resident_bytes -= entry["size"]
+            print(f"Server Process: Evicted model '{name}' to stay within the memory budget.")
+
+        # Drop shared tokenizers no resident model uses anymore
+        in_use = {entry["fingerprint"] for entry in list(self.resident.values()) + self.replaced}
+        for fingerprint in list(self.tokenizers):
+            if fingerprint not in in_use:
+                del self.tokenizers[fingerprint]
+
+
+def begin_request():
+    """
+    Admits a new request unless the server is draining.
+    Returns False if the request must be rejected.
+    """
+    global active_requests
+    with active_requests_lock:
+        if draining_flag.is_set():
+            return False
+        active_requests += 1
+        return True
+
+
+def end_request():
+    """Marks an admitted request as finished."""
+    global active_requests
+    with active_requests_lock:
+        active_requests -= 1
+
+
+def is_local_request():
+    """Checks whether the current Flask request comes from this machine."""
+    return request.remote_addr in LOOPBACK_ADDRESSES
+
+
+class RequestTrace:
+    """
+    Collects timed spans for a single request and exports them as Chrome trace JSON
+    (viewable in chrome://tracing or https://ui.perfetto.dev).
+    """
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.origin = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, name, start, end, **args):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def to_chrome_trace(self):
+        with self.lock:
+            return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+
+@contextmanager
+def trace_span(trace, name, **args):
+    """Records the enclosed block as a span on `trace`. Does nothing when tracing is off."""
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start, time.perf_counter(), **args)
+
+
+def start_trace(data):
+    """
+    Starts a trace if the request opted in with an 'X-Trace: 1' header or '"trace": true' in its body.
+    Returns None otherwise.
+    """
+    if request.headers.get('X-Trace', '').lower() not in ('1', 'true') and not data.get('trace'):
+        return None
+    trace = RequestTrace()
+    with stored_traces_lock:
+        stored_traces[trace.trace_id] = trace
+        while len(stored_traces) > MAX_STORED_TRACES:
+            stored_traces.popitem(last=False)
+    return trace
+
+
+class DecodeStepTracer(BaseStreamer):
+    """
+    Streamer that records the prefill and each decode step on a RequestTrace.
+    `generate` calls put() once with the prompt and then once per generated token.
+    """
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.last_put = None
+        self.steps = 0
+
+    def put(self, value):
+        now = time.perf_counter()
+        if self.last_put is not None:
+            self.trace.add("prefill" if self.steps == 0 else "decode_step", self.last_put, now, step=self.steps)
+            self.steps += 1
+        self.last_put = now
+
+    def end(self):
+        pass
+
+
+class TracingStreamer(TextIteratorStreamer):
+    """TextIteratorStreamer that also records decode steps and detokenize time on a RequestTrace."""
+
+    def __init__(self, tokenizer, trace, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.trace = trace
+        self.step_tracer = DecodeStepTracer(trace)
+
+    def put(self, value):
+        self.step_tracer.put(value)
+        with trace_span(self.trace, "detokenize"):
+            super().put(value)
+        # Keep detokenize time out of the next decode step
+        self.step_tracer.last_put = time.perf_counter()
+
+
+def sample_stacks(seconds, interval):
+    """
+    A minimal sampling profiler: samples the Python stack of every other thread
+    and returns them in folded format (one 'frame;frame;frame count' line per stack),
+    as used by flamegraph.pl and speedscope.
+    """
+    own_thread = threading.get_ident()
+    thread_names = {t.ident: t.name for t in threading.enumerate()}
+    stacks = Counter()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            # Walk the frames directly; traceback.extract_stack would read source lines for every frame
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            frames.append(thread_names.get(thread_id, str(thread_id)))
+            stacks[";".join(reversed(frames))] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+
+
+def profiler_activities():
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return activities
+
+
+class GenerationProfiler(StoppingCriteria):
+    """
+    Runs the torch profiler inside a generating thread while a /debug/profile?mode=torch window is open.
+    It is checked once per decode step as a stopping criterion that never stops generation.
+    The first generating thread to see the window claims the profiler; when it finishes or the window
+    closes, its events are handed in and another generating thread can take over.
+    """
+
+    def __init__(self):
+        self.prof = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.update()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    def update(self):
+        if self.prof is None and torch_profile_window.is_set():
+            if torch_profiler_lock.acquire(blocking=False):
+                self.prof = torch.profiler.profile(activities=profiler_activities())
+                self.prof.start()
+                torch_profile_started.set()
+        elif self.prof is not None and not torch_profile_window.is_set():
+            self.finish()
+
+    def finish(self):
+        if self.prof is None:
+            return
+        try:
+            self.prof.stop()
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                trace_path = os.path.join(tmp_dir, "trace.json")
+                self.prof.export_chrome_trace(trace_path)
+                with open(trace_path) as f:
+                    torch_profile_events.extend(json.load(f).get("traceEvents", []))
+        finally:
+            self.prof = None
+            torch_profiler_lock.release()
+
+
+class StopOnEvent(StoppingCriteria):
+    """Stops generation at the next decode step once any of the given events is set."""
+
+    def __init__(self, *events):
+        self.events = events
+
+    def __call__(self, input_ids, scores, **kwargs):
+        stop = any(event.is_set() for event in self.events)
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+
+def run_generate(model, stopping_criteria=(), **generation_kwargs):
+    """Calls `model.generate`, profiling it with the torch profiler if a profile window is open."""
+    profiler = GenerationProfiler()
+    profiler.update()
+    try:
+        return model.generate(
+            **generation_kwargs,
+            stopping_criteria=StoppingCriteriaList([profiler, *stopping_criteria]),
+        )
+    finally:
+        profiler.finish()
+
+
+def torch_profile(seconds):
+    """
+    Profiles the generations running during the next `seconds` with the torch profiler
+    and returns the merged Chrome trace JSON. Returns an empty trace if nothing was generated.
+    """
+    # The first profiler session of a process initialises the profiler and loses its events,
+    # so run a throwaway one before handing the profiler to the generating threads
+    with torch_profiler_lock:
+        with torch.profiler.profile(activities=profiler_activities()):
+            pass
+
+    torch_profile_events.clear()
+    torch_profile_started.clear()
+    torch_profile_window.set()
+    # Starting the profiler for the first time can take a few seconds, so the window
+    # is measured from when a generating thread actually starts profiling
+    if torch_profile_started.wait(timeout=seconds):
+        time.sleep(seconds)
+    torch_profile_window.clear()
+
+    # A generating thread stops its profiler at its next decode step; wait for it to hand in its events
+    if torch_profiler_lock.acquire(timeout=10):
+        torch_profiler_lock.release()
+    return json.dumps({"traceEvents": list(torch_profile_events), "displayTimeUnit": "ms"})
+
+
+# Per-request sampling parameters: name -> (type, check, description of valid values)
+SAMPLING_PARAMETERS = {
+    "temperature": (float, lambda v: v >= 0, ">= 0 (0 means greedy)"),
+    "top_k": (int, lambda v: v >= 0, "an integer >= 0 (0 disables it)"),
+    "top_p": (float, lambda v: 0 < v <= 1, "in (0, 1]"),
+    "min_p": (float, lambda v: 0 <= v <= 1, "in [0, 1]"),
+    "repetition_penalty": (float, lambda v: v > 0, "> 0 (1 disables it)"),
+    "presence_penalty": (float, lambda v: True, "a number (0 disables it)"),
+    # torch.Generator.manual_seed accepts 64-bit unsigned seeds
+    "seed": (int, lambda v: 0 <= v < 2 ** 64, "an integer in [0, 2**64)"),
+}
+
+MAX_BATCH_SIZE = 16
+# Number of most likely tokens top-p/min-p filtering looks at before falling back to a full sort
+SAMPLING_CANDIDATES = 1024
+
+
+def parse_sampling_params(data):
+    """
+    Reads the sampling parameters a request set explicitly.
+    Raises ValueError with a readable message if one is invalid.
+    """
+    params = {}
+    for name, (cast, check, valid) in SAMPLING_PARAMETERS.items():
+        raw = data.get(name)
+        if raw is None:
+            continue
+        # Reject booleans, and fractional values for integer parameters instead of truncating them
+        if isinstance(raw, bool) or (cast is int and isinstance(raw, float) and not raw.is_integer()):
+            raise ValueError(f"'{name}' must be {valid}.")
+        try:
+            value = cast(raw)
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f"'{name}' must be {valid}.")
+        if (cast is float and not math.isfinite(value)) or not check(value):
+            raise ValueError(f"'{name}' must be {valid}.")
+        params[name] = value
+    return params
+
+
+def default_sampling_params(model, do_sample):
+    """
+    Sampling parameters used when a request does not set them: the model's own
+    generation config when sampling, plain greedy decoding otherwise.
+    """
+    params = {"temperature": 0.0, "top_k": 0, "top_p": 1.0, "min_p": 0.0,
+              "repetition_penalty": 1.0, "presence_penalty": 0.0, "seed": None}
+    if do_sample:
+        config = model.generation_config
+        params.update({
+            "temperature": config.temperature if config.temperature is not None else 1.0,
+            "top_k": config.top_k or 0,
+            "top_p": config.top_p if config.top_p is not None else 1.0,
+            "min_p": config.min_p or 0.0,
+            "repetition_penalty": config.repetition_penalty or 1.0,
+        })
+    return params
+
+
+class BatchedSampler(LogitsProcessor):
+    """
+    Picks the next token of every row of a batch with a handful of tensor operations,
+    each row with its own temperature, top-k, top-p, min-p, repetition/presence penalty and seed.
+
+    It is meant to be the last processor of a greedy `generate` call: it returns scores where
+    only the sampled token is finite, so the greedy argmax selects exactly that token.
+    Rows with a seed draw their randomness from their own generator, so their output does not
+    depend on which other requests share the batch.
+    """
+
+    def __init__(self, params_list):
+        def column(name, dtype):
+            return torch.tensor([params[name] for params in params_list], dtype=dtype).unsqueeze(1)
+
+        self.temperature = column("temperature", torch.float32)
+        self.top_k = column("top_k", torch.long)
+        self.top_p = column("top_p", torch.float32)
+        self.min_p = column("min_p", torch.float32)
+        self.repetition_penalty = column("repetition_penalty", torch.float32)
+        self.presence_penalty = column("presence_penalty", torch.float32)
+        self.seeds = [params["seed"] for params in params_list]
+        self.generators = None
+
+        greedy = self.temperature.squeeze(1) == 0
+        unfiltered = ((self.top_k == 0) & (self.top_p >= 1) & (self.min_p == 0)).squeeze(1)
+        self.all_greedy = bool(greedy.all())
+        # Rows sampled from the whole vocabulary, and rows that need top-k/top-p/min-p filtering
+        self.full_rows = torch.nonzero(~greedy & unfiltered).squeeze(1)
+        self.filtered_rows = torch.nonzero(~greedy & ~unfiltered).squeeze(1)
+        self.use_repetition_penalty = bool((self.repetition_penalty != 1).any())
+        self.use_presence_penalty = bool((self.presence_penalty != 0).any())
+
+        # Filtering only looks at the most likely tokens instead of sorting the whole vocabulary:
+        # the largest top-k if every filtered row has one, otherwise a fixed candidate count
+        filtered_top_k = self.top_k[self.filtered_rows]
+        if len(filtered_top_k) and bool((filtered_top_k > 0).all()):
+            self.candidates = int(filtered_top_k.max())
+        else:
+            self.candidates = SAMPLING_CANDIDATES
+
+    def to(self, device):
+        for name in ("temperature", "top_k", "top_p", "min_p", "repetition_penalty", "presence_penalty",
+                     "full_rows", "filtered_rows"):
+            setattr(self, name, getattr(self, name).to(device))
+        self.generators = [
+            torch.Generator(device=device).manual_seed(seed) if seed is not None else None
+            for seed in self.seeds
+        ]
+
+    def __call__(self, input_ids, scores):
+        if self.generators is None:
+            self.to(scores.device)
+        scores = scores.float()
+
+        if self.use_repetition_penalty:
+            picked = scores.gather(1, input_ids)
+            picked = torch.where(picked < 0, picked * self.repetition_penalty, picked / self.repetition_penalty)
+            scores = scores.scatter(1, input_ids, picked)
+        if self.use_presence_penalty:
+            present = torch.zeros_like(scores, dtype=torch.bool).scatter_(1, input_ids, True)
+            scores = scores - self.presence_penalty * present
+
+        # Greedy rows keep the argmax; the other rows are overwritten with their sample
+        tokens = scores.argmax(dim=-1, keepdim=True)
+        if not self.all_greedy:
+            logits = scores / self.temperature.clamp(min=1e-5)
+            # One uniform per row and step, so a seeded row samples the same tokens whatever it is batched with
+            uniform = self.draw_uniforms(len(scores), scores.device)
+            if len(self.full_rows):
+                rows = self.full_rows
+                tokens[rows] = self.draw(logits[rows].softmax(dim=-1), uniform[rows])
+            if len(self.filtered_rows):
+                rows = self.filtered_rows
+                row_tokens, complete = self.filter_and_draw(logits[rows], rows, self.candidates, uniform[rows])
+                if not bool(complete.all()):
+                    # The candidates could not decide these rows exactly; redo them over the whole vocabulary
+                    redo = rows[~complete]
+                    row_tokens[~complete], _ = self.filter_and_draw(logits[redo], redo, logits.shape[-1],
+                                                                    uniform[redo])
+                tokens[rows] = row_tokens
+        return torch.full_like(scores, float("-inf")).scatter_(1, tokens, 0.0)
+
+    def filter_and_draw(self, logits, rows, candidates, uniform):
+        """
+        Applies top-k, top-p and min-p to the `candidates` most likely tokens of each row and samples one.
+        Also returns, per row, whether the candidates were enough for an exact result.
+        """
+        vocab_size = logits.shape[-1]
+        candidates = min(candidates, vocab_size)
+        if candidates < vocab_size:
+            sorted_logits, sorted_indices = logits.topk(candidates, dim=-1)
+        else:
+            sorted_logits, sorted_indices = logits.sort(dim=-1, descending=True)
+
+        top_k, top_p, min_p = self.top_k[rows], self.top_p[rows], self.min_p[rows]
+        ranks = torch.arange(candidates, device=logits.device).unsqueeze(0)
+        remove = (top_k > 0) & (ranks >= top_k)
+        kept_logits = sorted_logits.masked_fill(remove, float("-inf"))
+        # Probabilities are relative to the top-k tokens if the row has a top-k, to the whole vocabulary otherwise
+        within_top_k = (top_k > 0) & (top_k <= candidates)
+        log_norm = torch.where(within_top_k, kept_logits.logsumexp(dim=-1, keepdim=True),
+                               logits.logsumexp(dim=-1, keepdim=True))
+        probs = (kept_logits - log_norm).exp()
+        # Top-p keeps the smallest prefix whose probability reaches top_p (always at least one token)
+        remove |= (top_p < 1) & ((probs.cumsum(dim=-1) - probs) >= top_p)
+        remove |= probs < min_p * probs[:, :1]
+
+        # A row is decided exactly if its top-k fits in the candidates, or if top-p/min-p already
+        # drop the last candidate, so no token outside the candidates could have survived
+        complete = (within_top_k | ((top_k == 0) & remove[:, -1:])).squeeze(1) | (candidates == vocab_size)
+        choice = self.draw(sorted_logits.masked_fill(remove, float("-inf")).softmax(dim=-1), uniform)
+        return sorted_indices.gather(1, choice), complete
+
+    def draw_uniforms(self, batch_size, device):
+        """Draws one uniform per row, from the row's own generator if it has a seed."""
+        uniform = torch.rand(batch_size, 1, device=device)
+        for row, generator in enumerate(self.generators):
+            if generator is not None:
+                uniform[row] = torch.rand(1, generator=generator, device=device)
+        return uniform
+
+    def draw(self, probs, uniform):
+        """Samples one index per row by inverting its cumulative distribution with the row's uniform draw."""
+        cdf = probs.cumsum(dim=-1)
+        choice = torch.searchsorted(cdf, uniform * cdf[:, -1:], right=True)
+        return choice.clamp_(max=probs.shape[-1] - 1)
+
+
+def sampling_generate_kwargs(params_list):
+    """
+    Arguments for `model.generate` that apply per-row sampling through BatchedSampler.
+    The built-in sampling is switched off so the model's generation config does not interfere.
+    """
+    return dict(
+        logits_processor=LogitsProcessorList([BatchedSampler(params_list)]),
+        do_sample=False, temperature=None, top_k=None, top_p=None, min_p=None, repetition_penalty=None,
+    )
+
+
 def run_flask_app():
     """
     Initializes and runs the Flask application to serve the model.
@@ -25,63 +742,104 @@ def run_flask_app():
     
     app = Flask(__name__)
 
-    # --- Load the Model and Tokenizer (only once when the process starts) ---
-    local_model_path = "./gemma-3-270m-it-local"
-    device = "cpu"  # Change to "cuda" if you have a compatible GPU
+    # --- Set up the Model Registry and load the default model up front ---
+    try:
+        registry = ModelRegistry.from_config(MODEL_REGISTRY_CONFIG)
+    except ValueError as e:
+        print(f"Server Process: Invalid model configuration: {e}")
+        return
+    device = registry.device
 
     print("Server Process: Loading model and tokenizer...")
     try:
-        # Check if the path exists to give a better error message
-        if not os.path.isdir(local_model_path):
-            raise FileNotFoundError(f"The model directory was not found at '{local_model_path}'. Please ensure it's in the same folder as the script.")
-        
-        tokenizer = AutoTokenizer.from_pretrained(local_model_path)
-        model = AutoModelForCausalLM.from_pretrained(local_model_path)
-        model.to(device)
+        registry.release(registry.acquire())
         print("Server Process: Model loaded successfully!")
     except Exception as e:
+        # Other models can still be served; the default one is retried on its next request
         print(f"Server Process: Error loading model: {e}")
-        model = None
+
+    def acquire_model(name):
+        """Returns (entry, error message, status code) for the model a request asked for."""
+        try:
+            return registry.acquire(name), None, None
+        except KeyError:
+            return None, f"Unknown model '{name or registry.default_model}'.", 404
+        except Exception as e:
+            print(f"Server Process: Error loading model: {e}")
+            return None, "Model is not loaded. Check the terminal for errors.", 500
 
     # --- Enhanced Streaming Endpoint with Stop Functionality ---
     @app.route('/generate-stream', methods=['POST'])
     def stream_generate():
         global current_generation_thread, stop_generation_flag
-        
-        if model is None:
-            return Response("Error: Model is not loaded. Check the terminal for errors.", status=500, mimetype='text/plain')
-        
-        data = request.get_json()
+
+        if not begin_request():
+            return Response("Error: Server is shutting down.", status=503, mimetype='text/plain')
+
+        data = request.get_json(silent=True) or {}
         prompt = data.get('prompt')
 
         if not prompt:
+            end_request()
             return Response("Error: Prompt not provided.", status=400, mimetype='text/plain')
 
+        try:
+            sampling_overrides = parse_sampling_params(data)
+        except ValueError as e:
+            end_request()
+            return Response(f"Error: {e}", status=400, mimetype='text/plain')
+
+        trace = start_trace(data)
+        with trace_span(trace, "acquire_model"):
+            entry, error, status = acquire_model(data.get('model'))
+        if entry is None:
+            end_request()
+            return Response(f"Error: {error}", status=status, mimetype='text/plain')
+        tokenizer, model = entry["tokenizer"], entry["model"]
+        sampling_params = {**default_sampling_params(model, do_sample=True), **sampling_overrides}
+        accepted = time.perf_counter()
+
         # Reset the stop flag for new generation
         stop_generation_flag.clear()
+        # Set once the stream stops reading (stop request, client disconnect, error), so generate stops too
+        stream_stopped = threading.Event()
+        generation = {"thread": None}
 
         def generate_tokens():
             global current_generation_thread, stop_generation_flag
             
             try:
-                messages = [{"role": "user", "content": prompt}]
-                inputs = tokenizer.apply_chat_template(
-                    messages, add_generation_prompt=True, tokenize=True,
-                    return_dict=True, return_tensors="pt"
-                ).to(model.device)
-
-                streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True)
+                if trace is not None:
+                    # Time from the request being accepted until the server starts running its stream
+                    trace.add("queue_wait", accepted, time.perf_counter())
+                with trace_span(trace, "tokenize"):
+                    messages = [{"role": "user", "content": prompt}]
+                    inputs = tokenizer.apply_chat_template(
+                        messages, add_generation_prompt=True, tokenize=True,
+                        return_dict=True, return_tensors="pt"
+                    ).to(model.device)
+
+                if trace is not None:
+                    streamer = TracingStreamer(tokenizer, trace, skip_special_tokens=True)
+                else:
+                    streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True)
 
                 # Custom generation function that checks for stop flag
                 def generation_with_stop():
-                    generation_kwargs = dict(**inputs, streamer=streamer, max_new_tokens=4000, do_sample=True)
+                    generation_kwargs = dict(**inputs, streamer=streamer, max_new_tokens=4000,
+                                             **sampling_generate_kwargs([sampling_params]))
                     try:
-                        model.generate(**generation_kwargs)
+                        run_generate(model, stopping_criteria=[StopOnEvent(stream_stopped, stop_generation_flag)],
+                                     **generation_kwargs)
                     except Exception as e:
                         print(f"Generation error: {e}")
+                    finally:
+                        # The model stays in use until generate returns, which can be after the stream closed
+                        registry.release(entry)
 
                 # Run generation in a separate thread
                 current_generation_thread = threading.Thread(target=generation_with_stop)
+                generation["thread"] = current_generation_thread
                 current_generation_thread.start()
 
                 print("Server Process: Starting stream...")
@@ -94,7 +852,9 @@ def run_flask_app():
                         break
                     
                     generated_tokens += 1
-                    yield new_text
+                    # The generator resumes once the server has written the chunk out
+                    with trace_span(trace, "network_write"):
+                        yield new_text
                     
                     # Optional: Stop if no client is listening (connection dropped)
                     # This is handled by Flask automatically when client disconnects
@@ -108,9 +868,21 @@ def run_flask_app():
             except Exception as e:
                 print(f"Server Process: Error during generation: {e}")
                 stop_generation_flag.set()
+            finally:
+                stream_stopped.set()
+
+        def release_model():
+            # Once the generation thread has started, it releases the model itself
+            if generation["thread"] is None:
+                registry.release(entry)
         
-        # Return the streaming response
-        return Response(generate_tokens(), mimetype='text/plain')
+        # Return the streaming response; the request stays in flight until the stream is closed
+        response = Response(generate_tokens(), mimetype='text/plain')
+        response.call_on_close(release_model)
+        response.call_on_close(end_request)
+        if trace is not None:
+            response.headers['X-Trace-Id'] = trace.trace_id
+        return response
 
     # --- Stop Generation Endpoint ---
     @app.route('/stop-generation', methods=['POST'])
@@ -127,27 +899,184 @@ def run_flask_app():
         is_generating = current_generation_thread is not None and current_generation_thread.is_alive()
         return jsonify({
             "is_generating": is_generating,
-            "stop_requested": stop_generation_flag.is_set()
+            "stop_requested": stop_generation_flag.is_set(),
+            "active_requests": active_requests,
+            "draining": draining_flag.is_set(),
+            "default_model": registry.default_model,
+            "resident_models": registry.resident_models(),
+            "reloading": model_reload_lock.locked()
         }), 200
 
     # --- Original Non-Streaming Endpoint ---
     @app.route('/generate', methods=['POST'])
     def generate_text():
-        if model is None:
-            return jsonify({"error": "Model is not loaded."}), 500
-        
-        data = request.get_json()
-        prompt = data.get('prompt')
-        if not prompt:
-            return jsonify({"error": "Prompt not provided."}), 400
-        
-        input_ids = tokenizer(prompt, return_tensors="pt").to(device)
-        outputs = model.generate(**input_ids, max_new_tokens=150)
-        response_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        return jsonify({"response": response_text})
+        if not begin_request():
+            return jsonify({"error": "Server is shutting down."}), 503
+
+        entry = None
+        try:
+            data = request.get_json(silent=True) or {}
+            prompt = data.get('prompt')
+            if not prompt:
+                return jsonify({"error": "Prompt not provided."}), 400
+
+            try:
+                sampling_overrides = parse_sampling_params(data)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
+            trace = start_trace(data)
+            with trace_span(trace, "acquire_model"):
+                entry, error, status = acquire_model(data.get('model'))
+            if entry is None:
+                return jsonify({"error": error}), status
+            tokenizer, model = entry["tokenizer"], entry["model"]
+            sampling_params = {**default_sampling_params(model, do_sample=False), **sampling_overrides}
+
+            with trace_span(trace, "tokenize"):
+                input_ids = tokenizer(prompt, return_tensors="pt").to(device)
+            streamer = DecodeStepTracer(trace) if trace is not None else None
+            outputs = run_generate(model, **input_ids, max_new_tokens=150, streamer=streamer,
+                                   **sampling_generate_kwargs([sampling_params]))
+            with trace_span(trace, "detokenize"):
+                response_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
+
+            result = {"response": response_text}
+            if trace is None:
+                return jsonify(result)
+
+            result["trace_id"] = trace.trace_id
+            response = jsonify(result)
+            # The body is written after the view returns; the span ends when the response is closed
+            write_start = time.perf_counter()
+            response.call_on_close(lambda: trace.add("network_write", write_start, time.perf_counter()))
+            return response
+        finally:
+            if entry is not None:
+                registry.release(entry)
+            end_request()
+
+    # --- Batched Non-Streaming Endpoint ---
+    @app.route('/generate-batch', methods=['POST'])
+    def generate_batch():
+        if not begin_request():
+            return jsonify({"error": "Server is shutting down."}), 503
+
+        entry = None
+        try:
+            data = request.get_json(silent=True) or {}
+            batch = data.get('requests')
+            if not isinstance(batch, list) or not batch:
+                return jsonify({"error": "'requests' must be a non-empty list."}), 400
+            if len(batch) > MAX_BATCH_SIZE:
+                return jsonify({"error": f"At most {MAX_BATCH_SIZE} requests per batch."}), 400
+
+            prompts, overrides = [], []
+            for i, item in enumerate(batch):
+                if not isinstance(item, dict) or not item.get('prompt'):
+                    return jsonify({"error": f"Request {i}: prompt not provided."}), 400
+                try:
+                    overrides.append(parse_sampling_params(item))
+                except ValueError as e:
+                    return jsonify({"error": f"Request {i}: {e}"}), 400
+                prompts.append(item['prompt'])
+
+            entry, error, status = acquire_model(data.get('model'))
+            if entry is None:
+                return jsonify({"error": error}), status
+            tokenizer, model = entry["tokenizer"], entry["model"]
+
+            # Every row keeps its own sampling parameters inside the single generate call
+            defaults = default_sampling_params(model, do_sample=False)
+            params_list = [{**defaults, **item_overrides} for item_overrides in overrides]
+
+            inputs = tokenizer(prompts, return_tensors="pt", padding=True, padding_side="left").to(device)
+            outputs = run_generate(model, **inputs, max_new_tokens=150, **sampling_generate_kwargs(params_list))
+            responses = tokenizer.batch_decode(outputs, skip_special_tokens=True)
+            return jsonify({"responses": responses})
+        finally:
+            if entry is not None:
+                registry.release(entry)
+            end_request()
+
+    # --- Model Registry Endpoint ---
+    @app.route('/models', methods=['GET'])
+    def list_models():
+        return jsonify(registry.status()), 200
+
+    # --- Profiling Endpoints ---
+    @app.route('/debug/trace/<trace_id>', methods=['GET'])
+    def get_trace(trace_id):
+        with stored_traces_lock:
+            trace = stored_traces.get(trace_id)
+        if trace is None:
+            return jsonify({"error": f"No trace with id '{trace_id}'."}), 404
+        return jsonify(trace.to_chrome_trace()), 200
+
+    @app.route('/debug/profile', methods=['GET'])
+    def profile():
+        seconds = request.args.get('seconds', default=5, type=float)
+        mode = request.args.get('mode', default='sample')
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            return jsonify({"error": f"'seconds' must be between 0 and {MAX_PROFILE_SECONDS}."}), 400
+        if mode not in ('sample', 'torch'):
+            return jsonify({"error": "'mode' must be 'sample' or 'torch'."}), 400
+        if not profile_lock.acquire(blocking=False):
+            return jsonify({"error": "A profile is already being captured."}), 409
+
+        try:
+            print(f"Server Process: Profiling live traffic for {seconds}s ({mode})...")
+            if mode == 'torch':
+                return Response(torch_profile(seconds), mimetype='application/json')
+            return Response(sample_stacks(seconds, PROFILE_SAMPLE_INTERVAL), mimetype='text/plain')
+        finally:
+            profile_lock.release()
+
+    # --- Graceful Shutdown Endpoint ---
+    @app.route('/drain', methods=['POST'])
+    def drain():
+        if not is_local_request():
+            return jsonify({"error": "Draining is only allowed from localhost."}), 403
+        # Stop admitting new requests; in-flight generations are left to finish
+        draining_flag.set()
+        print(f"Server Process: Draining, {active_requests} request(s) still in flight.")
+        return jsonify({"message": "Server is draining", "active_requests": active_requests}), 200
+
+    # --- Hot Model Reload Endpoint ---
+    @app.route('/reload-model', methods=['POST'])
+    def reload_model():
+        if not is_local_request():
+            return jsonify({"error": "Model reloads are only allowed from localhost."}), 403
+        data = request.get_json(silent=True) or {}
+        name = data.get('model') or registry.default_model
+        model_path = data.get('model_path') or registry.paths.get(name)
+
+        if draining_flag.is_set():
+            return jsonify({"error": "Server is shutting down."}), 503
+        if model_path is None:
+            return jsonify({"error": f"Unknown model '{name}', provide a 'model_path' to add it."}), 404
+        if not os.path.isdir(model_path):
+            return jsonify({"error": f"Model directory not found: '{model_path}'"}), 400
+        if not model_reload_lock.acquire(blocking=False):
+            return jsonify({"error": "A model reload is already in progress."}), 409
+
+        def load_and_swap():
+            try:
+                # The new model is loaded next to the old one, which keeps serving meanwhile
+                registry.reload(name, model_path)
+                print(f"Server Process: Model '{name}' now served from '{model_path}'.")
+            except Exception as e:
+                print(f"Server Process: Error reloading model '{name}', keeping the current one: {e}")
+            finally:
+                model_reload_lock.release()
+
+        threading.Thread(target=load_and_swap, daemon=True).start()
+        return jsonify({"message": "Model reload started", "model": name, "model_path": model_path}), 202
         
     @app.route('/health', methods=['GET'])
     def health_check():
+        if draining_flag.is_set():
+            return "Draining", 503
         return "OK", 200
 
     print("Server Process: Starting Flask server on http://127.0.0.1:5000")
@@ -165,6 +1094,8 @@ class ModelHostApp:
 
         self.server_process = None
         self.status_update_job = None
+        self.drain_job = None
+        self.pending_on_stopped = None  # called once the server has stopped, e.g. to close the window
 
         style = ttk.Style()
         style.configure('TButton', font=('Helvetica', 12), padding=10)
@@ -191,12 +1122,18 @@ class ModelHostApp:
         self.start_button = ttk.Button(button_frame, text="Start Server", command=self.start_server, style='TButton')
         self.start_button.pack(side=tk.LEFT, expand=True, padx=5)
 
+        self.reload_button = ttk.Button(button_frame, text="Reload Model", command=self.reload_model, state=tk.DISABLED, style='TButton')
+        self.reload_button.pack(side=tk.LEFT, expand=True, padx=5)
+
         self.stop_button = ttk.Button(button_frame, text="Stop Server", command=self.stop_server, state=tk.DISABLED, style='TButton')
         self.stop_button.pack(side=tk.RIGHT, expand=True, padx=5)
 
         self.status_label = ttk.Label(server_frame, text="Status: Idle", style='Status.TLabel')
         self.status_label.pack(pady=5)
 
+        self.model_label = ttk.Label(server_frame, text="Model: -", style='Status.TLabel')
+        self.model_label.pack(pady=(0, 5))
+
         # Generation Control Section
         generation_frame = ttk.LabelFrame(main_frame, text="Generation Control", padding="15")
         generation_frame.pack(fill=tk.X, pady=10)
@@ -294,8 +1231,12 @@ class ModelHostApp:
             "API Endpoints:\n"
             "  • Streaming: POST http://127.0.0.1:5000/generate-stream\n"
             "  • Complete response: POST http://127.0.0.1:5000/generate\n"
+            "  • Batched responses: POST http://127.0.0.1:5000/generate-batch\n"
             "  • Stop generation: POST http://127.0.0.1:5000/stop-generation\n"
-            "  • Generation status: GET http://127.0.0.1:5000/generation-status"
+            "  • Generation status: GET http://127.0.0.1:5000/generation-status\n"
+            "  • Hot model reload: POST http://127.0.0.1:5000/reload-model\n"
+            "  • Available models: GET http://127.0.0.1:5000/models\n"
+            "  • Graceful drain: POST http://127.0.0.1:5000/drain"
         )
         instructions_label = ttk.Label(instructions_frame, text=instructions_text, justify=tk.LEFT, wraplength=600)
         instructions_label.pack(fill=tk.X)
@@ -428,6 +1369,12 @@ def check_status():
             status_data = response.json()
             is_generating = status_data.get('is_generating', False)
             stop_requested = status_data.get('stop_requested', False)
+
+            resident_models = status_data.get('resident_models') or ['-']
+            model_text = f"Default model: {status_data.get('default_model', '-')} | Resident: {', '.join(resident_models)}"
+            if status_data.get('reloading', False):
+                model_text += " (reloading...)"
+            self.model_label.config(text=model_text)
             
             if is_generating:
                 if stop_requested:
@@ -549,6 +1496,7 @@ def check_status():
         if self.server_process and self.server_process.is_alive():
             self.status_label.config(text="Status: Running on http://127.0.0.1:5000")
             self.stop_button.config(state=tk.NORMAL)
+            self.reload_button.config(state=tk.NORMAL)
             # Enable generation control buttons
             self.refresh_status_button.config(state=tk.NORMAL)
             self.test_stream_button.config(state=tk.NORMAL)
@@ -560,22 +1508,82 @@ def check_status():
             self.status_label.config(text="Status: Error - Failed to start server. Check terminal.")
             self.start_button.config(state=tk.NORMAL)
 
-    def stop_server(self):
+    def reload_model(self):
+        """Ask for a model directory and hot-swap the served model to it."""
+        if not self.server_process or not self.server_process.is_alive():
+            self.log_to_output("Server is not running!")
+            return
+
+        model_path = filedialog.askdirectory(title="Select model directory", initialdir=os.getcwd())
+        if not model_path:
+            return
+
+        response = self.make_request("http://127.0.0.1:5000/reload-model", method='POST', data={"model_path": model_path})
+        if response is not None and response.status_code == 202:
+            self.log_to_output(f"Reloading model from '{model_path}'. The current model keeps serving until it is ready.")
+            self.manual_refresh_status()
+        elif response is not None:
+            self.log_to_output(f"Reload failed: {response.json().get('error', response.text)}")
+        else:
+            self.log_to_output("Failed to send reload request")
+
+    def stop_server(self, on_stopped=None):
+        """
+        Stops the server gracefully: new requests are refused while in-flight
+        generations get up to DRAIN_TIMEOUT_SECONDS to finish.
+        """
         # Cancel auto-refresh
         if self.status_update_job:
             self.root.after_cancel(self.status_update_job)
             self.status_update_job = None
-            
-        if self.server_process and self.server_process.is_alive():
+
+        # Kept until the server has stopped, so a call made while a drain is underway still gets it
+        if on_stopped:
+            self.pending_on_stopped = on_stopped
+
+        if not self.server_process or not self.server_process.is_alive():
+            self.status_label.config(text="Status: Idle (Server was not running)")
+            self.finish_stop_server()
+            return
+
+        if self.drain_job:
+            # A drain is already underway
+            return
+
+        self.stop_button.config(state=tk.DISABLED)
+        self.reload_button.config(state=tk.DISABLED)
+        self.status_label.config(text="Status: Draining in-flight requests...")
+        self.make_request("http://127.0.0.1:5000/drain", method='POST')
+        self.wait_for_drain(time.time() + DRAIN_TIMEOUT_SECONDS)
+
+    def wait_for_drain(self, deadline):
+        """Poll the server until no request is in flight or the deadline passes."""
+        self.drain_job = None
+        active = 0
+        if self.server_process.is_alive():
+            response = self.make_request("http://127.0.0.1:5000/generation-status")
+            if response is not None and response.status_code == 200:
+                active = response.json().get('active_requests', 0)
+
+        if active > 0 and time.time() < deadline:
+            self.status_label.config(text=f"Status: Draining ({active} request(s) in flight)...")
+            self.drain_job = self.root.after(500, lambda: self.wait_for_drain(deadline))
+            return
+
+        if self.server_process.is_alive():
             self.server_process.terminate()
             self.server_process.join()
-            self.status_label.config(text="Status: Server Stopped")
+        if active > 0:
+            self.status_label.config(text=f"Status: Server Stopped (drain timed out, {active} request(s) cut off)")
         else:
-            self.status_label.config(text="Status: Idle (Server was not running)")
-            
+            self.status_label.config(text="Status: Server Stopped")
+        self.finish_stop_server()
+
+    def finish_stop_server(self):
         # Disable generation control buttons
         self.start_button.config(state=tk.NORMAL)
         self.stop_button.config(state=tk.DISABLED)
+        self.reload_button.config(state=tk.DISABLED)
         self.stop_generation_button.config(state=tk.DISABLED)
         self.refresh_status_button.config(state=tk.DISABLED)
         self.test_stream_button.config(state=tk.DISABLED)
@@ -583,6 +1591,11 @@ def check_status():
         
         # Reset generation status
         self.generation_status_label.config(text="Idle", foreground='green')
+        self.model_label.config(text="Model: -")
+
+        on_stopped, self.pending_on_stopped = self.pending_on_stopped, None
+        if on_stopped:
+            on_stopped()
 
     def on_closing(self):
         # Cancel any scheduled updates
@@ -590,8 +1603,10 @@ def check_status():
             self.root.after_cancel(self.status_update_job)
             
         if self.server_process and self.server_process.is_alive():
-            self.stop_server()
-        self.root.destroy()
+            # Let in-flight generations finish before the window goes away
+            self.stop_server(on_stopped=self.root.destroy)
+        else:
+            self.root.destroy()
 
 
 if __name__ == "__main__":